@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import copy
 import logging
+import os
 import yaml
 import html
 import random
 import re
+from collections import OrderedDict
 from typing import Dict, Any, List, Tuple
 
 from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.utils import executor
 from aiogram.types import PollAnswer
 
@@ -20,8 +22,51 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Prefer the libyaml C loader when PyYAML was built with it
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Parsed configs keyed by absolute path: (mtime, size, data)
+_YAML_CACHE: "OrderedDict[str, Tuple[float, int, Dict[str, Any]]]" = OrderedDict()
+_YAML_CACHE_MAX = 100
+
+# Question pack markers: a block ends on its author line
+_BLOCK_END_RE = re.compile(r'^(?:автор|авторка):.*$', re.IGNORECASE | re.MULTILINE)
+
+WELCOME_TEXT = (
+    "🤖 Group Poll Bot\n\n"
+    "I can create polls in this group using predefined questions.\n\n"
+    "Available commands:\n"
+    "/make_poll [poll_number] - Create a poll by number\n"
+    "/choice [names] - Randomly choose from a list of names\n"
+    "/question - Send a random question from file\n"
+    "/list_polls - List all available polls\n"
+    "/help - Show help information\n\n"
+    "Example:\n"
+    "/make_poll 0 - Creates a poll by number\n"
+    "/make_poll 1 - Creates another poll by number"
+)
+
+HELP_TEXT = (
+    "📋 How to use Group Poll Bot:\n\n"
+    "1. Use /list_polls to see all available polls\n"
+    "2. Use /make_poll [poll_number] to create a specific poll\n"
+    "3. Use /choice [names] to randomly choose from a list\n"
+    "4. Use /question to send a random question\n\n"
+    "Examples:\n"
+    "• /make_poll 0 - First poll\n"
+    "• /make_poll 1 - Second poll\n"
+    "• /choice John, Bob, Juan, Roman - Randomly choose a name\n\n"
+    "Poll Types:\n"
+    "• Regular polls - Multiple choice questions\n"
+    "• Quiz polls - Questions with correct answers\n\n"
+    "Note: Poll numbers are defined in the poll configuration."
+)
+
 
 class PollBot:
+    # Translation table mapping each MarkdownV2 special character to its escaped form
+    _MDV2_TABLE = str.maketrans({c: '\\' + c for c in "_*[]()~`>#+-=|{}.!\\"})
+    
     def __init__(
         self,
         secrets_config_path: str = "secrets_config.yaml",
@@ -31,8 +76,8 @@ class PollBot:
         self.secrets_config = self.load_config(secrets_config_path)
         self.poll_config = self.load_config(poll_config_path)
         self.bot = Bot(token=self.secrets_config['telegram_bot']['token'])
-        self.storage = MemoryStorage()
-        self.dp = Dispatcher(self.bot, storage=self.storage)
+        # No handler uses FSM states, so keep aiogram's default DisabledStorage
+        self.dp = Dispatcher(self.bot)
         self.polls = self.poll_config.get('polls', [])
         
         # Create polls dictionary for quick lookup by number
@@ -40,88 +85,100 @@ class PollBot:
             poll['number']: poll for poll in self.polls if 'number' in poll
         }
         
+        self._available_numbers_str = ", ".join(
+            str(poll['number']) for poll in self.polls if 'number' in poll
+        )
+        
+        # Poll config is static, so prepare send_poll arguments up front.
+        # A malformed poll is left without '_params' so it only fails when requested.
+        for number, poll in self.polls_by_number.items():
+            try:
+                poll['_params'] = self.build_poll_params(poll)
+            except Exception as e:
+                logger.error("Error preparing poll %s: %s", number, e)
+        
+        # Polls are static for the bot's lifetime, so render the list once
+        self._poll_list_text = self.build_poll_list_text()
+        
+        # Parsed question packs keyed by path: (mtime, size, blocks)
+        self._pack_cache: Dict[str, Tuple[float, int, List[Tuple[str, str]]]] = {}
+        # HTML payloads keyed by (question, spoiler) text
+        self._rendered_blocks: Dict[Tuple[str, str], Tuple[List[str], List[str]]] = {}
+        
+        self._rng = random.Random()
+        
         # Register handlers
         self.register_handlers()
     
     def load_config(self, config_path: str) -> Dict[str, Any]:
-        """Load configuration from YAML file."""
+        """Load configuration from YAML file, reusing the parsed result while the file is unchanged."""
         try:
-            with open(config_path, 'r', encoding='utf-8') as file:
-                return yaml.safe_load(file)
+            path = os.path.abspath(config_path)
+            st = os.stat(path)
+            entry = _YAML_CACHE.get(path)
+            if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+                _YAML_CACHE.move_to_end(path)
+                return copy.deepcopy(entry[2])
+            
+            with open(path, 'r', encoding='utf-8') as file:
+                data = yaml.load(file, Loader=_YAML_LOADER)
+            
+            _YAML_CACHE[path] = (st.st_mtime, st.st_size, data)
+            _YAML_CACHE.move_to_end(path)
+            if len(_YAML_CACHE) > _YAML_CACHE_MAX:
+                _YAML_CACHE.popitem(last=False)
+            return copy.deepcopy(data)
         except FileNotFoundError:
-            logger.error(f"Config file {config_path} not found!")
+            logger.error("Config file %s not found!", config_path)
             raise
         except yaml.YAMLError as e:
-            logger.error(f"Error parsing YAML config: {e}")
+            logger.error("Error parsing YAML config: %s", e)
             raise
     
+    def build_poll_list_text(self) -> str:
+        """Render the /list_polls response for the configured polls."""
+        if not self.polls:
+            return "❌ No polls available in configuration."
+        
+        parts: List[str] = ["📊 Available Polls:\n\n"]
+        for poll in self.polls:
+            poll_type = "🧩 Quiz" if poll.get('type') == 'quiz' else "📝 Regular"
+            parts.append(
+                f"Number: {poll.get('number', '?')}\n"
+                f"ID: {poll.get('id', '?')}\n"
+                f"Question: {poll.get('question', '?')}\n"
+                f"Type: {poll_type}\n"
+                f"Options: {len(poll.get('options') or [])}\n\n"
+            )
+        
+        parts.append("Usage: /make_poll [poll_number]\n")
+        parts.append("Example: /make_poll 0")
+        return "".join(parts)
+    
     def register_handlers(self):
         """Register all bot handlers."""
         
         @self.dp.message_handler(commands=['start'])
         async def start_command(message: types.Message):
             """Handle /start command."""
-            welcome_text = (
-                "🤖 Group Poll Bot\n\n"
-                "I can create polls in this group using predefined questions.\n\n"
-                "Available commands:\n"
-                "/make_poll [poll_number] - Create a poll by number\n"
-                "/choice [names] - Randomly choose from a list of names\n"
-                "/question - Send a random question from file\n"
-                "/list_polls - List all available polls\n"
-                "/help - Show help information\n\n"
-                "Example:\n"
-                "/make_poll 0 - Creates a poll by number\n"
-                "/make_poll 1 - Creates another poll by number"
-            )
-            await message.answer(welcome_text)
+            await message.answer(WELCOME_TEXT)
         
         @self.dp.message_handler(commands=['help'])
         async def help_command(message: types.Message):
             """Handle /help command."""
-            help_text = (
-                "📋 How to use Group Poll Bot:\n\n"
-                "1. Use /list_polls to see all available polls\n"
-                "2. Use /make_poll [poll_number] to create a specific poll\n"
-                "3. Use /choice [names] to randomly choose from a list\n"
-                "4. Use /question to send a random question\n\n"
-                "Examples:\n"
-                "• /make_poll 0 - First poll\n"
-                "• /make_poll 1 - Second poll\n"
-                "• /choice John, Bob, Juan, Roman - Randomly choose a name\n\n"
-                "Poll Types:\n"
-                "• Regular polls - Multiple choice questions\n"
-                "• Quiz polls - Questions with correct answers\n\n"
-                "Note: Poll numbers are defined in the poll configuration."
-            )
-            await message.answer(help_text)
+            await message.answer(HELP_TEXT)
         
         @self.dp.message_handler(commands=['list_polls'])
         async def list_polls_command(message: types.Message):
             """List all available polls with their numbers."""
-            if not self.polls:
-                await message.answer("❌ No polls available in configuration.")
-                return
-            
-            poll_list = "📊 Available Polls:\n\n"
-            for poll in self.polls:
-                poll_type = "🧩 Quiz" if poll.get('type') == 'quiz' else "📝 Regular"
-                poll_list += f"Number: {poll['number']}\n"
-                poll_list += f"ID: {poll['id']}\n"
-                poll_list += f"Question: {poll['question']}\n"
-                poll_list += f"Type: {poll_type}\n"
-                poll_list += f"Options: {len(poll.get('options', []))}\n\n"
-            
-            poll_list += "Usage: /make_poll [poll_number]\n"
-            poll_list += "Example: /make_poll 0"
-            
-            await message.answer(poll_list)
+            await message.answer(self._poll_list_text)
         
         @self.dp.message_handler(commands=['make_poll'])
         async def make_poll_command(message: types.Message):
             """Create a poll by number."""
             # Check if command has arguments
-            if not message.get_args():
+            args = message.get_args()
+            if not args:
                 await message.answer(
                     "❌ Usage: /make_poll [poll_number]\n\n"
                     "Example: /make_poll 0\n\n"
@@ -129,8 +186,8 @@ class PollBot:
                 )
                 return
             
-            poll_number_raw = message.get_args().strip()
-            if not poll_number_raw.isdigit():
+            poll_number_raw = args.strip()
+            if not (poll_number_raw.isascii() and poll_number_raw.isdigit()):
                 await message.answer(
                     "❌ Poll number must be a non-negative integer.\n\n"
                     "Example: /make_poll 0"
@@ -141,12 +198,9 @@ class PollBot:
             
             # Check if poll exists
             if poll_number not in self.polls_by_number:
-                available_numbers = ", ".join(
-                    [str(poll['number']) for poll in self.polls if 'number' in poll]
-                )
                 await message.answer(
                     f"❌ Poll number not found: {poll_number}\n\n"
-                    f"Available poll numbers: {available_numbers}\n\n"
+                    f"Available poll numbers: {self._available_numbers_str}\n\n"
                     "Use /list_polls for more details."
                 )
                 return
@@ -166,10 +220,13 @@ class PollBot:
                 is_anonymous = "Anonymous" if poll_data.get('is_anonymous', True) else "Not Anonymous"
                 multiple_answers = "Multiple answers allowed" if poll_data.get('allows_multiple_answers', False) else "Single answer only"
                 
-                logger.info(f"Poll '{poll_number}' created in chat {message.chat.id} by user {message.from_user.id}")
+                logger.info(
+                    "Poll '%s' created in chat %s by user %s",
+                    poll_number, message.chat.id, message.from_user.id
+                )
                 
             except Exception as e:
-                logger.error(f"Error creating poll {poll_number}: {e}")
+                logger.error("Error creating poll %s: %s", poll_number, e)
                 await message.answer(
                     f"❌ Error creating poll: {str(e)}\n\n"
                     "Please try again or contact an administrator."
@@ -180,7 +237,8 @@ class PollBot:
         async def choice_command(message: types.Message):
             """Randomly choose from a list of names."""
             # Check if command has arguments
-            if not message.get_args():
+            args = message.get_args()
+            if not args:
                 await message.answer(
                     "❌ Usage: /choice [names separated by commas]\n\n"
                     "Example: /choice John, Bob, Juan, Roman\n\n"
@@ -188,11 +246,11 @@ class PollBot:
                 )
                 return
             
-            names_input = message.get_args().strip()
+            names_input = args.strip()
             
             try:
                 # Split names by comma and clean them
-                names = [name.strip() for name in names_input.split(',') if name.strip()]
+                names = [name for name in (part.strip() for part in names_input.split(',')) if name]
                 
                 if len(names) < 2:
                     await message.answer(
@@ -202,7 +260,7 @@ class PollBot:
                     return
                 
                 # Randomly select a name
-                chosen_name = random.choice(names)
+                chosen_name = names[self._rng.randrange(len(names))]
                 
                 # Create a nice response
                 names_list = ", ".join(names)
@@ -214,10 +272,13 @@ class PollBot:
                 
                 await message.answer(response, parse_mode='Markdown')
                 
-                logger.info(f"Random choice made by user {message.from_user.id}: {chosen_name} from {names}")
+                logger.info(
+                    "Random choice made by user %s: %s from %s",
+                    message.from_user.id, chosen_name, names
+                )
                 
             except Exception as e:
-                logger.error(f"Error in choice command: {e}")
+                logger.error("Error in choice command: %s", e)
                 await message.answer(
                     "❌ Error processing the choice command.\n\n"
                     "Please make sure to separate names with commas.\n"
@@ -236,145 +297,143 @@ class PollBot:
                 await message.answer(f"❌ {str(e)}")
                 return
             except Exception as e:
-                logger.error(f"Error loading question: {e}")
+                logger.error("Error loading question: %s", e)
                 await message.answer("❌ Error loading question.")
                 return
             
-            if spoiler_text:
-                question_chunks = self.split_message_chunks(question_text)
-                spoiler_chunks = self.split_message_chunks(spoiler_text)
-                
-                for chunk in question_chunks:
-                    await message.answer(self.escape_html(chunk), parse_mode='HTML')
-                
-                for chunk in spoiler_chunks:
-                    payload = f"<span class=\"tg-spoiler\">{self.escape_html(chunk)}</span>"
-                    await message.answer(payload, parse_mode='HTML')
-            else:
-                for chunk in self.split_message_chunks(question_text):
-                    await message.answer(self.escape_html(chunk), parse_mode='HTML')
+            question_payloads, spoiler_payloads = self.render_question_block(
+                question_text, spoiler_text
+            )
+            
+            # Send one at a time so chunks arrive in order, spoiler last
+            for payload in question_payloads:
+                await message.answer(payload, parse_mode='HTML')
+            
+            for payload in spoiler_payloads:
+                await message.answer(payload, parse_mode='HTML')
         
         @self.dp.poll_answer_handler()
         async def handle_poll_answer(poll_answer: PollAnswer):
             """Handle poll answers (optional - for analytics)."""
-            logger.info(f"Poll answer received: User {poll_answer.user.id} answered poll {poll_answer.poll_id}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "Poll answer received: User %s answered poll %s",
+                    poll_answer.user.id, poll_answer.poll_id
+                )
     
-    def escape_markdown(self, text: str) -> str:
-        """Escape special characters that might cause Markdown parsing issues."""
-        # Escape common Markdown special characters
-        special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-        for char in special_chars:
-            text = text.replace(char, f'\\{char}')
-        return text
-
     def escape_markdown_v2(self, text: str) -> str:
         """Escape text for Telegram MarkdownV2."""
-        special_chars = r'_*[]()~`>#+-=|{}.!\\'
-        for char in special_chars:
-            text = text.replace(char, f'\\{char}')
-        return text
+        return text.translate(self._MDV2_TABLE)
     
     def escape_html(self, text: str) -> str:
         """Escape text for Telegram HTML parse mode."""
-        return html.escape(text)
+        # Quotes only need escaping inside attributes, not in message text
+        return html.escape(text, quote=False)
+    
+    def render_question_block(self, question_text: str, spoiler_text: str) -> Tuple[List[str], List[str]]:
+        """Return HTML payloads for a question block, reusing earlier renders."""
+        key = (question_text, spoiler_text)
+        rendered = self._rendered_blocks.get(key)
+        if rendered is None:
+            question_payloads = [
+                self.escape_html(chunk) for chunk in self.split_message_chunks(question_text)
+            ]
+            spoiler_payloads = [
+                f"<span class=\"tg-spoiler\">{self.escape_html(chunk)}</span>"
+                for chunk in self.split_message_chunks(spoiler_text)
+            ] if spoiler_text else []
+            rendered = (question_payloads, spoiler_payloads)
+            self._rendered_blocks[key] = rendered
+        return rendered
     
     def split_message_chunks(self, text: str, max_len: int = 4000) -> List[str]:
         """Split text into chunks that fit Telegram limits."""
         if len(text) <= max_len:
             return [text]
         
-        chunks = []
-        current = []
-        current_len = 0
-        for line in text.splitlines(keepends=True):
-            if len(line) > max_len:
-                if current:
-                    chunks.append("".join(current).strip())
-                    current = []
-                    current_len = 0
-                for i in range(0, len(line), max_len):
-                    chunks.append(line[i:i + max_len].strip())
-                continue
-            
-            if current_len + len(line) > max_len:
-                chunks.append("".join(current).strip())
-                current = [line]
-                current_len = len(line)
-            else:
-                current.append(line)
-                current_len += len(line)
+        chunks: List[str] = []
+        start = 0
+        while len(text) - start > max_len:
+            # Break after the last newline that fits, or hard-split a long line
+            end = text.rfind('\n', start, start + max_len) + 1
+            if end <= start:
+                end = start + max_len
+            chunk = text[start:end].strip()
+            if chunk:
+                chunks.append(chunk)
+            start = end
         
-        if current:
-            chunks.append("".join(current).strip())
+        chunk = text[start:].strip()
+        if chunk:
+            chunks.append(chunk)
         
-        return [chunk for chunk in chunks if chunk]
+        return chunks
     
     def get_random_question_block(self, file_path: str) -> Tuple[str, str]:
-        """Load a random question block and split it into visible/spoiler parts."""
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
+        """Return a random question block split into visible/spoiler parts."""
+        st = os.stat(file_path)
+        cached = self._pack_cache.get(file_path)
+        if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            blocks = cached[2]
+        else:
+            with open(file_path, 'r', encoding='utf-8') as file:
+                content = file.read()
+            blocks = self.parse_question_blocks(content)
+            self._pack_cache[file_path] = (st.st_mtime, st.st_size, blocks)
+            # Renders of blocks from the previous version are no longer reachable
+            self._rendered_blocks.clear()
         
+        if not blocks:
+            raise ValueError("No question blocks found in random_pack.txt.")
+        
+        return self._rng.choice(blocks)
+    
+    def parse_question_blocks(self, content: str) -> List[Tuple[str, str]]:
+        """Split pack content into (question, spoiler) pairs, one per block."""
         blocks: List[str] = []
-        current: List[str] = []
-        for line in content.splitlines():
-            current.append(line)
-            if line.lower().startswith("автор:") or line.lower().startswith("авторка:"):
-                block = "\n".join(current).strip()
-                if block:
-                    blocks.append(block)
-                current = []
+        prev = 0
+        for match in _BLOCK_END_RE.finditer(content):
+            block = content[prev:match.end()].strip()
+            if block:
+                blocks.append(block)
+            prev = match.end()
         
-        trailing = "\n".join(current).strip()
+        trailing = content[prev:].strip()
         if trailing:
             blocks.append(trailing)
         
-        if not blocks:
-            raise ValueError("No question blocks found in random_pack.txt.")
-        
-        block = random.choice(blocks)
-        if len(block) > 10000:
-            raise ValueError("Selected block is too long (over 10000 characters).")
-        block_lines = block.splitlines()
-        
+        # Blocks too long to send are skipped rather than failing when picked
+        return [
+            self.split_question_block(block) for block in blocks if len(block) <= 10000
+        ]
+    
+    def split_question_block(self, block: str) -> Tuple[str, str]:
+        """Split a single block into visible question text and spoiler text."""
         # Trim any preamble before the first "Вопрос" line
-        question_start = None
-        for idx, line in enumerate(block_lines):
-            if line.strip().startswith("Вопрос"):
-                question_start = idx
-                break
-        if question_start is not None:
-            block_lines = block_lines[question_start:]
+        if not block.startswith("Вопрос"):
+            question_start = block.find("\nВопрос")
+            if question_start != -1:
+                block = block[question_start + 1:]
         
-        spoiler_index = None
-        for idx, line in enumerate(block_lines):
-            if line.strip().startswith("Ответ:"):
-                spoiler_index = idx
-                break
+        spoiler_start = 0 if block.startswith("Ответ:") else block.find("\nОтвет:")
+        if spoiler_start == -1:
+            return block.strip(), ""
         
-        if spoiler_index is None:
-            return "\n".join(block_lines).strip(), ""
-        
-        question_text = "\n".join(block_lines[:spoiler_index]).strip()
-        spoiler_text = "\n".join(block_lines[spoiler_index:]).strip()
+        question_text = block[:spoiler_start].strip()
+        spoiler_text = block[spoiler_start:].strip()
         return question_text, spoiler_text
     
     
-    async def create_poll_in_chat(self, chat_id: int, poll_data: Dict[str, Any]) -> types.Message:
-        """Create a poll in the specified chat."""
-        question = self.escape_markdown(poll_data['question'])
-        options = [self.escape_markdown(option) for option in poll_data['options']]
+    def build_poll_params(self, poll_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the send_poll keyword arguments for a configured poll."""
         poll_type = poll_data.get('type', 'regular')
         
-        # Get new poll options
-        is_anonymous = poll_data.get('is_anonymous', True)
-        allows_multiple_answers = poll_data.get('allows_multiple_answers', False)
-        
-        # Prepare poll parameters
+        # Bot API sends poll questions and options as plain text, so no escaping
         poll_params = {
-            'question': question,
-            'options': options,
-            'is_anonymous': is_anonymous,
-            'allows_multiple_answers': allows_multiple_answers,
+            'question': poll_data['question'],
+            'options': list(poll_data['options']),
+            'is_anonymous': poll_data.get('is_anonymous', True),
+            'allows_multiple_answers': poll_data.get('allows_multiple_answers', False),
             'type': poll_type
         }
         
@@ -386,15 +445,38 @@ class PollBot:
             
             explanation = poll_data.get('explanation')
             if explanation:
+                explanation_parse_mode = poll_data.get('explanation_parse_mode')
+                if explanation_parse_mode == 'MarkdownV2':
+                    explanation = self.escape_markdown_v2(explanation)
+                if explanation_parse_mode:
+                    poll_params['explanation_parse_mode'] = explanation_parse_mode
                 poll_params['explanation'] = explanation
         
+        return poll_params
+    
+    async def create_poll_in_chat(self, chat_id: int, poll_data: Dict[str, Any]) -> types.Message:
+        """Create a poll in the specified chat."""
+        poll_params = poll_data.get('_params')
+        if poll_params is None:
+            poll_params = self.build_poll_params(poll_data)
+        
         # Send the poll
         poll_message = await self.bot.send_poll(chat_id=chat_id, **poll_params)
-        logger.info(f"Poll created in chat {chat_id}: {question} (anonymous: {is_anonymous}, multiple: {allows_multiple_answers})")
+        logger.info(
+            "Poll created in chat %s: %s (anonymous: %s, multiple: %s)",
+            chat_id, poll_params['question'],
+            poll_params['is_anonymous'], poll_params['allows_multiple_answers']
+        )
         return poll_message
     
     def run(self):
         """Start the bot."""
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            pass
+        
         logger.info("Starting Group Poll Bot...")
         executor.start_polling(self.dp, skip_updates=True)
 
@@ -403,5 +485,5 @@ if __name__ == '__main__':
         bot = PollBot()
         bot.run()
     except Exception as e:
-        logger.error(f"Failed to start bot: {e}")
+        logger.error("Failed to start bot: %s", e)
         raise